@@ -5,22 +5,288 @@ FastAPI service that uses BAML for screenshot analysis.
 Run with: uvicorn main:app --port 8420
 """
 
-import base64
+import asyncio
+import io
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime
 from pathlib import Path
+from typing import Literal
 
+import aiofiles
+import orjson
+import pybase64
+from baml_py import Image
+from baml_py.errors import BamlClientFinishReasonError, BamlValidationError
 from fastapi import FastAPI, HTTPException
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response
+from PIL import Image as PILImage
 from pydantic import BaseModel
 
 # Import generated BAML client
 from baml_client import b
 from baml_client.types import ScreenActivity, AppContext, ActivitySummary
 
+logger = logging.getLogger(__name__)
+
+# Micro-batching for /analyze
+BATCH_MAX_SIZE = 8
+BATCH_MAX_WAIT = 0.05  # seconds
+
+
+class ScreenActivityBatcher:
+    """Collects concurrent /analyze requests into a single BAML call"""
+
+    def __init__(self, max_batch_size: int = BATCH_MAX_SIZE, max_wait_time: float = BATCH_MAX_WAIT):
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+        # (image, timestamp, future) tuples waiting to be batched
+        self._queue: asyncio.Queue[tuple] = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+        # batch task -> the batch it is processing
+        self._in_flight: dict[asyncio.Task, list[tuple]] = {}
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        in_flight = dict(self._in_flight)
+        for task in in_flight:
+            task.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+        # A task cancelled before it started never reaches _process's handler
+        for batch in in_flight.values():
+            self._cancel_batch(batch)
+        while not self._queue.empty():
+            self._cancel_batch([self._queue.get_nowait()])
+
+    @staticmethod
+    def _cancel_batch(batch: list[tuple]):
+        for _, _, future in batch:
+            if not future.done():
+                future.cancel()
+
+    async def submit(self, image, timestamp: str) -> ScreenActivity:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image, timestamp, future))
+        return await future
+
+    async def _collect_batch(self) -> list[tuple]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait_time
+        try:
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            self._cancel_batch(batch)
+            raise
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+            # Keep collecting the next batch while this one is with the LLM
+            task = asyncio.create_task(self._process(batch))
+            self._in_flight[task] = batch
+            task.add_done_callback(lambda t: self._in_flight.pop(t, None))
+
+    async def _process(self, batch: list[tuple]):
+        try:
+            results = await self._extract(batch)
+        except asyncio.CancelledError:
+            self._cancel_batch(batch)
+            raise
+        except Exception as e:
+            # Rate limits, timeouts and transport errors fail the whole batch
+            # rather than being retried per item against a throttling provider
+            logger.warning("Batch of %d screenshots failed: %s", len(batch), e)
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, timestamp, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result.model_copy(update={"timestamp": timestamp}))
+
+    async def _extract(self, batch: list[tuple]) -> list:
+        """One result (or per-item exception) per batch item, in order"""
+        if len(batch) > 1:
+            timestamps = [timestamp for _, timestamp, _ in batch]
+            try:
+                results = await b.ExtractScreenActivityBatch(
+                    screenshots=[image for image, _, _ in batch],
+                    timestamps=timestamps,
+                )
+            except (BamlValidationError, BamlClientFinishReasonError) as e:
+                logger.warning(
+                    "Batch of %d screenshots returned unparseable output, retrying one by one: %s",
+                    len(batch), e,
+                )
+            else:
+                # Echoed timestamps are the only check that the LLM kept order
+                if [result.timestamp for result in results] == timestamps:
+                    return results
+                logger.warning(
+                    "Batch of %d screenshots came back as %d results or out of order, retrying one by one",
+                    len(batch), len(results),
+                )
+
+        return await asyncio.gather(
+            *(
+                b.ExtractScreenActivity(screenshot=image, timestamp=timestamp)
+                for image, timestamp, _ in batch
+            ),
+            return_exceptions=True,
+        )
+
+
+batcher = ScreenActivityBatcher()
+
+
+# Perceptual-hash cache for near-duplicate screenshots
+CACHE_MAX_ENTRIES = 256
+CACHE_TTL = 15 * 60  # seconds
+HAMMING_THRESHOLD = 5  # bits out of 64 that may differ for a cache hit
+
+
+def dhash(image_data: bytes) -> int | None:
+    """64-bit difference hash of an encoded image, or None if it can't be decoded"""
+    try:
+        with PILImage.open(io.BytesIO(image_data)) as img:
+            small = img.convert("L").resize((9, 8), PILImage.Resampling.BILINEAR)
+    except Exception:
+        return None
+
+    pixels = small.tobytes()
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def dhash_base64(image_base64: str) -> int | None:
+    """dhash of a base64-encoded image"""
+    return dhash(pybase64.b64decode(image_base64))
+
+
+class ActivityCache:
+    """LRU of recent ScreenActivity results, matched by Hamming distance"""
+
+    def __init__(
+        self,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        ttl: float = CACHE_TTL,
+        threshold: int = HAMMING_THRESHOLD,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        # hash -> (stored_at, activity), least recently used first
+        self._entries: OrderedDict[int, tuple[float, ScreenActivity]] = OrderedDict()
+
+    def get(self, image_hash: int) -> ScreenActivity | None:
+        now = time.monotonic()
+        best_key = None
+        best_distance = self.threshold + 1
+        for key, (stored_at, _) in list(self._entries.items()):
+            if now - stored_at > self.ttl:
+                del self._entries[key]
+                continue
+            distance = (key ^ image_hash).bit_count()
+            if distance < best_distance:
+                best_key, best_distance = key, distance
+
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        return self._entries[best_key][1]
+
+    def put(self, image_hash: int, activity: ScreenActivity):
+        self._entries[image_hash] = (time.monotonic(), activity)
+        self._entries.move_to_end(image_hash)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+activity_cache = ActivityCache()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    batcher.start()
+    yield
+    await batcher.stop()
+
+
 app = FastAPI(
     title="Monitome Analysis Service",
     description="Screenshot analysis using BAML + Gemini",
     version="0.1.0",
+    lifespan=lifespan,
 )
+# Compress larger JSON bodies for clients that send Accept-Encoding: gzip.
+# uvicorn only speaks HTTP/1.1; put an HTTP/2 proxy in front if needed.
+app.add_middleware(GZipMiddleware, minimum_size=512)
+
+
+# Fallback timestamp, formatted at most once per second
+_last_timestamp: tuple[int, str] = (0, "")
+
+
+def now_timestamp() -> str:
+    """Current local time as an ISO string with second precision"""
+    global _last_timestamp
+    second = int(time.time())
+    if _last_timestamp[0] != second:
+        _last_timestamp = (second, datetime.fromtimestamp(second).isoformat())
+    return _last_timestamp[1]
+
+
+# Screenshot formats accepted by the analysis endpoints
+ImageMediaType = Literal["image/png", "image/jpeg", "image/webp"]
+
+
+def sniff_media_type(image_data: bytes) -> ImageMediaType | None:
+    """Detect the image format from its magic bytes"""
+    if image_data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if image_data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if image_data[:4] == b"RIFF" and image_data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def image_from_bytes(media_type: str, image_data: bytes) -> Image:
+    """BAML image from raw bytes (CPU-bound; run it in a worker thread)"""
+    # baml_py.Image has no raw-bytes constructor, so encode exactly once
+    return Image.from_base64(media_type, pybase64.b64encode_as_string(image_data))
 
 
 # Request/Response models
@@ -28,6 +294,7 @@ class AnalyzeRequest(BaseModel):
     """Request to analyze a screenshot"""
     image_base64: str
     timestamp: str  # ISO format
+    media_type: ImageMediaType = "image/png"
 
 
 class AnalyzeFileRequest(BaseModel):
@@ -39,66 +306,85 @@ class AnalyzeFileRequest(BaseModel):
 class QuickExtractRequest(BaseModel):
     """Request for quick app extraction"""
     image_base64: str
+    media_type: ImageMediaType = "image/png"
 
 
 class SummarizeRequest(BaseModel):
     """Request to summarize activities"""
-    activities: list[dict]
+    activities: list[ScreenActivity]
+
+
+# Health check (static body, serialized once)
+HEALTH_RESPONSE = Response(
+    content=orjson.dumps({"status": "ok", "service": "monitome-analysis"}),
+    media_type="application/json",
+)
 
 
-# Health check
 @app.get("/health")
 async def health():
-    return {"status": "ok", "service": "monitome-analysis"}
+    return HEALTH_RESPONSE
 
 
 # Analyze screenshot from base64
-@app.post("/analyze", response_model=dict)
+@app.post("/analyze", response_model=ScreenActivity)
 async def analyze_screenshot(request: AnalyzeRequest):
     """Analyze a screenshot and extract activity information"""
     try:
-        from baml_py import Image
-
-        image = Image.from_base64("image/png", request.image_base64)
-        result: ScreenActivity = await b.ExtractScreenActivity(
-            screenshot=image,
-            timestamp=request.timestamp
-        )
-        return result.model_dump()
+        # Decoding and hashing are CPU-bound; keep them off the event loop
+        image_hash = await asyncio.to_thread(dhash_base64, request.image_base64)
+        if image_hash is not None:
+            cached = activity_cache.get(image_hash)
+            if cached is not None:
+                return cached.model_copy(update={"timestamp": request.timestamp})
+
+        image = await asyncio.to_thread(Image.from_base64, request.media_type, request.image_base64)
+        result: ScreenActivity = await batcher.submit(image, request.timestamp)
+        if image_hash is not None:
+            activity_cache.put(image_hash, result)
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 # Analyze screenshot from file path
-@app.post("/analyze-file", response_model=dict)
+@app.post("/analyze-file", response_model=ScreenActivity)
 async def analyze_file(request: AnalyzeFileRequest):
     """Analyze a screenshot from a file path"""
     try:
-        from baml_py import Image
-
         path = Path(request.file_path)
-        if not path.exists():
+        if not await asyncio.to_thread(path.exists):
             raise HTTPException(status_code=404, detail=f"File not found: {request.file_path}")
 
-        image_data = path.read_bytes()
-        image_b64 = base64.b64encode(image_data).decode()
+        timestamp = request.timestamp or now_timestamp()
+        async with aiofiles.open(path, "rb") as f:
+            image_data = await f.read()
 
-        # Determine media type
-        suffix = path.suffix.lower()
-        media_type = {
+        # Determine media type from content, falling back to the extension
+        media_type = sniff_media_type(image_data) or {
             ".png": "image/png",
             ".jpg": "image/jpeg",
             ".jpeg": "image/jpeg",
-        }.get(suffix, "image/png")
+            ".webp": "image/webp",
+        }.get(path.suffix.lower(), "image/png")
 
-        image = Image.from_base64(media_type, image_b64)
-        timestamp = request.timestamp or datetime.now().isoformat()
+        image_hash = await asyncio.to_thread(dhash, image_data)
+        if image_hash is not None:
+            cached = activity_cache.get(image_hash)
+            if cached is not None:
+                return cached.model_copy(update={"timestamp": timestamp})
+
+        # Don't keep the file bytes alive across the LLM call
+        image = await asyncio.to_thread(image_from_bytes, media_type, image_data)
+        del image_data
 
         result: ScreenActivity = await b.ExtractScreenActivity(
             screenshot=image,
             timestamp=timestamp
         )
-        return result.model_dump()
+        if image_hash is not None:
+            activity_cache.put(image_hash, result)
+        return result
     except HTTPException:
         raise
     except Exception as e:
@@ -106,32 +392,37 @@ async def analyze_file(request: AnalyzeFileRequest):
 
 
 # Quick extract - just get app info
-@app.post("/quick-extract", response_model=dict)
+@app.post("/quick-extract", response_model=AppContext)
 async def quick_extract(request: QuickExtractRequest):
     """Quick extraction of app context only"""
     try:
-        from baml_py import Image
-
-        image = Image.from_base64("image/png", request.image_base64)
+        image = await asyncio.to_thread(Image.from_base64, request.media_type, request.image_base64)
         result: AppContext = await b.QuickExtract(screenshot=image)
-        return result.model_dump()
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 # Summarize activities
-@app.post("/summarize", response_model=dict)
+@app.post("/summarize", response_model=ActivitySummary)
 async def summarize_activities(request: SummarizeRequest):
     """Summarize a list of screen activities"""
     try:
-        # Convert dicts to ScreenActivity objects
-        activities = [ScreenActivity(**a) for a in request.activities]
-        result: ActivitySummary = await b.SummarizeActivities(activities=activities)
-        return result.model_dump()
+        result: ActivitySummary = await b.SummarizeActivities(activities=request.activities)
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=8420)
+
+    # BAML's generated client is async (default_client_mode "async" in
+    # generators.baml), so one worker already overlaps requests; extra workers
+    # add process-level parallelism, each with its own batcher and cache.
+    uvicorn.run(
+        "main:app",
+        host="127.0.0.1",
+        port=8420,
+        workers=int(os.getenv("MONITOME_SERVICE_WORKERS", "1")),
+    )
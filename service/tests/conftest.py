@@ -0,0 +1,21 @@
+import pytest
+
+
+def make_activity(description: str = "Editing code", timestamp: str = "2026-01-01T00:00:00"):
+    # The generated client only exists after `baml-cli generate`; test modules
+    # skip themselves when it is missing.
+    from baml_client.types import ActivityType, AppCategory, AppContext, ScreenActivity
+
+    return ScreenActivity(
+        timestamp=timestamp,
+        app=AppContext(app_name="Editor", window_title=None, app_category=AppCategory.IDE),
+        activity_type=ActivityType.Coding,
+        description=description,
+        key_content=[],
+        urls=[],
+    )
+
+
+@pytest.fixture
+def activity():
+    return make_activity
@@ -0,0 +1,99 @@
+import io
+
+import pytest
+from PIL import Image as PILImage
+
+pytest.importorskip("baml_client")
+
+import main
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    return now
+
+
+def flip_bits(value: int, count: int) -> int:
+    return value ^ ((1 << count) - 1)
+
+
+def png_bytes(image: PILImage.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def gradient(width: int = 64, height: int = 48) -> PILImage.Image:
+    image = PILImage.new("L", (width, height))
+    image.putdata([(x * 4 + y) % 256 for y in range(height) for x in range(width)])
+    return image
+
+
+def test_hamming_threshold_boundary(clock, activity):
+    cache = main.ActivityCache(threshold=5)
+    cached = activity()
+    cache.put(0xF0F0_F0F0_F0F0_F0F0, cached)
+
+    assert cache.get(flip_bits(0xF0F0_F0F0_F0F0_F0F0, 5)) is cached
+    assert cache.get(flip_bits(0xF0F0_F0F0_F0F0_F0F0, 6)) is None
+
+
+def test_closest_entry_wins(clock, activity):
+    cache = main.ActivityCache(threshold=5)
+    near, far = activity("near"), activity("far")
+    cache.put(0b0000, near)
+    cache.put(0b1110, far)
+
+    assert cache.get(0b0001) is near
+
+
+def test_entries_expire_after_ttl(clock, activity):
+    cache = main.ActivityCache(ttl=60)
+    cache.put(42, activity())
+
+    clock[0] += 60
+    assert cache.get(42) is not None
+
+    clock[0] += 1
+    assert cache.get(42) is None
+
+
+def test_least_recently_used_entry_is_evicted(clock, activity):
+    cache = main.ActivityCache(max_entries=2, threshold=0)
+    first, second, third = activity("first"), activity("second"), activity("third")
+    cache.put(1, first)
+    cache.put(2, second)
+
+    # Touch 1 so 2 becomes the least recently used
+    assert cache.get(1) is first
+    cache.put(3, third)
+
+    assert cache.get(1) is first
+    assert cache.get(2) is None
+    assert cache.get(3) is third
+
+
+def test_dhash_matches_for_same_image_in_different_formats():
+    image = gradient()
+    jpeg = io.BytesIO()
+    image.save(jpeg, format="JPEG", quality=90)
+
+    png_hash = main.dhash(png_bytes(image))
+    jpeg_hash = main.dhash(jpeg.getvalue())
+
+    assert png_hash is not None
+    assert (png_hash ^ jpeg_hash).bit_count() <= main.HAMMING_THRESHOLD
+
+
+def test_dhash_differs_for_different_images():
+    flipped = gradient().transpose(PILImage.Transpose.FLIP_LEFT_RIGHT)
+
+    distance = (main.dhash(png_bytes(gradient())) ^ main.dhash(png_bytes(flipped))).bit_count()
+
+    assert distance > main.HAMMING_THRESHOLD
+
+
+def test_dhash_of_non_image_is_none():
+    assert main.dhash(b"not an image") is None
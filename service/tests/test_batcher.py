@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("baml_client")
+
+import main
+from baml_py.errors import BamlValidationError
+
+
+class FakeBaml:
+    """Stands in for the BAML client; screenshots are plain strings"""
+
+    def __init__(self, activity):
+        self.activity = activity
+        self.batch_error: Exception | None = None
+        # Applied to the batch results, to simulate a misbehaving LLM
+        self.mangle_batch = lambda results: results
+        self.batch_sizes: list[int] = []
+        self.single_calls: list[str] = []
+
+    async def ExtractScreenActivityBatch(self, screenshots, timestamps):
+        self.batch_sizes.append(len(screenshots))
+        if self.batch_error:
+            raise self.batch_error
+        return self.mangle_batch(
+            [self.activity(description=s, timestamp=t) for s, t in zip(screenshots, timestamps)]
+        )
+
+    async def ExtractScreenActivity(self, screenshot, timestamp):
+        self.single_calls.append(screenshot)
+        if screenshot == "broken":
+            raise ValueError("bad screenshot")
+        return self.activity(description=screenshot, timestamp="from the llm")
+
+
+@pytest.fixture
+def fake_b(monkeypatch, activity):
+    fake = FakeBaml(activity)
+    monkeypatch.setattr(main, "b", fake)
+    return fake
+
+
+def run_with_batcher(coro_fn, **kwargs):
+    async def runner():
+        batcher = main.ScreenActivityBatcher(**kwargs)
+        batcher.start()
+        try:
+            return await coro_fn(batcher)
+        finally:
+            await batcher.stop()
+
+    return asyncio.run(runner())
+
+
+def test_batches_are_capped_at_max_size(fake_b):
+    async def submit_all(batcher):
+        return await asyncio.gather(*(batcher.submit(f"shot-{i}", f"ts-{i}") for i in range(19)))
+
+    results = run_with_batcher(submit_all, max_batch_size=8, max_wait_time=0.2)
+
+    assert fake_b.batch_sizes == [8, 8, 3]
+    assert fake_b.single_calls == []
+    assert [r.description for r in results] == [f"shot-{i}" for i in range(19)]
+
+
+def test_batch_results_map_back_to_requests(fake_b):
+    async def submit_all(batcher):
+        return await asyncio.gather(*(batcher.submit(f"shot-{i}", f"ts-{i}") for i in range(3)))
+
+    results = run_with_batcher(submit_all, max_batch_size=8, max_wait_time=0.05)
+
+    assert fake_b.batch_sizes == [3]
+    assert [(r.description, r.timestamp) for r in results] == [
+        ("shot-0", "ts-0"),
+        ("shot-1", "ts-1"),
+        ("shot-2", "ts-2"),
+    ]
+
+
+def test_requests_after_deadline_go_in_next_batch(fake_b):
+    async def submit_staggered(batcher):
+        first = asyncio.ensure_future(batcher.submit("early", "ts-0"))
+        await asyncio.sleep(0.15)
+        second = await batcher.submit("late", "ts-1")
+        return await first, second
+
+    first, second = run_with_batcher(submit_staggered, max_batch_size=8, max_wait_time=0.05)
+
+    assert fake_b.batch_sizes == []
+    assert fake_b.single_calls == ["early", "late"]
+    assert (first.description, second.description) == ("early", "late")
+
+
+def submit_three(batcher):
+    return asyncio.gather(
+        batcher.submit("a", "ts-a"),
+        batcher.submit("broken", "ts-b"),
+        batcher.submit("c", "ts-c"),
+        return_exceptions=True,
+    )
+
+
+@pytest.mark.parametrize(
+    "misbehave",
+    [
+        pytest.param(
+            lambda fake: setattr(
+                fake, "batch_error", BamlValidationError("prompt", "unparseable", "raw", "detail")
+            ),
+            id="unparseable",
+        ),
+        pytest.param(lambda fake: setattr(fake, "mangle_batch", lambda r: r[:2]), id="too-few"),
+        pytest.param(lambda fake: setattr(fake, "mangle_batch", lambda r: r[::-1]), id="reordered"),
+    ],
+)
+def test_unusable_batch_output_falls_back_to_single_calls(fake_b, misbehave):
+    misbehave(fake_b)
+
+    a, broken, c = run_with_batcher(submit_three, max_batch_size=8, max_wait_time=0.05)
+
+    assert fake_b.batch_sizes == [3]
+    assert sorted(fake_b.single_calls) == ["a", "broken", "c"]
+    assert (a.description, a.timestamp) == ("a", "ts-a")
+    assert isinstance(broken, ValueError)
+    assert (c.description, c.timestamp) == ("c", "ts-c")
+
+
+def test_batch_call_errors_fail_every_request_without_retrying(fake_b):
+    fake_b.batch_error = RuntimeError("429 rate limited")
+
+    results = run_with_batcher(submit_three, max_batch_size=8, max_wait_time=0.05)
+
+    assert fake_b.batch_sizes == [3]
+    assert fake_b.single_calls == []
+    assert all(result is fake_b.batch_error for result in results)
+
+
+def test_stop_cancels_in_flight_requests(monkeypatch, activity):
+    class SlowBaml(FakeBaml):
+        async def ExtractScreenActivity(self, screenshot, timestamp):
+            await asyncio.sleep(10)
+
+    monkeypatch.setattr(main, "b", SlowBaml(activity))
+
+    async def runner():
+        batcher = main.ScreenActivityBatcher(max_wait_time=0.01)
+        batcher.start()
+        pending = asyncio.ensure_future(batcher.submit("slow", "ts"))
+        await asyncio.sleep(0.05)
+        await batcher.stop()
+        await asyncio.sleep(0)
+        return pending
+
+    assert asyncio.run(runner()).cancelled()
@@ -0,0 +1,30 @@
+import io
+
+import pytest
+from PIL import Image as PILImage
+
+pytest.importorskip("baml_client")
+
+import main
+
+
+def encode(format: str) -> bytes:
+    buffer = io.BytesIO()
+    PILImage.new("RGB", (4, 4), "white").save(buffer, format=format)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize(
+    ("format", "media_type"),
+    [("PNG", "image/png"), ("JPEG", "image/jpeg"), ("WEBP", "image/webp")],
+)
+def test_sniffs_supported_formats(format, media_type):
+    assert main.sniff_media_type(encode(format)) == media_type
+
+
+@pytest.mark.parametrize(
+    "data",
+    [b"", b"GIF89a\x01\x00", b"RIFF\x00\x00\x00\x00WAVEfmt ", b"plain text"],
+)
+def test_unknown_content_is_none(data):
+    assert main.sniff_media_type(data) is None
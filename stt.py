@@ -8,7 +8,7 @@ Usage:
   python stt.py --list-devices
 
 Requirements:
-  pip install websockets sounddevice
+  pip install websockets sounddevice pybase64 orjson
 
 This script reads ELEVENLABS_API_KEY from:
 1) process environment, then
@@ -19,16 +19,30 @@ from __future__ import annotations
 
 import argparse
 import asyncio
-import base64
-import json
+import functools
+import inspect
 import os
 import sys
+import threading
+from collections import deque
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
 from urllib.parse import urlencode
 
 MISSING_DEPS: list[str] = []
 
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None  # type: ignore[assignment]
+    MISSING_DEPS.append("orjson")
+
+try:
+    import pybase64
+except ModuleNotFoundError:
+    pybase64 = None  # type: ignore[assignment]
+    MISSING_DEPS.append("pybase64")
+
 try:
     import sounddevice as sd
 except ModuleNotFoundError:
@@ -42,6 +56,7 @@ except ModuleNotFoundError:
     MISSING_DEPS.append("websockets")
 
 
+@functools.lru_cache(maxsize=1)
 def load_api_key() -> str:
     key = os.getenv("ELEVENLABS_API_KEY")
     if key:
@@ -103,6 +118,18 @@ def parse_args() -> argparse.Namespace:
         default=100,
         help="Audio chunk size in milliseconds.",
     )
+    parser.add_argument(
+        "--batch-ms",
+        type=int,
+        default=200,
+        help="Minimum audio per WebSocket message in milliseconds.",
+    )
+    parser.add_argument(
+        "--max-backlog-secs",
+        type=float,
+        default=10.0,
+        help="Audio to hold while the connection is slow before dropping the oldest.",
+    )
     parser.add_argument(
         "--device",
         default=None,
@@ -116,14 +143,17 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--previous-text",
         default=None,
-        help="Optional short context sent with first chunk only.",
+        help="Optional short context sent with the first chunk of a session.",
     )
     parser.add_argument(
         "--list-devices",
         action="store_true",
         help="List audio devices and exit.",
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.batch_ms <= 0:
+        parser.error("--batch-ms must be greater than 0")
+    return args
 
 
 def make_ws_url(args: argparse.Namespace) -> str:
@@ -141,41 +171,188 @@ def make_ws_url(args: argparse.Namespace) -> str:
     )
 
 
+class AudioChunkBuffer:
+    """Hands audio chunks from the PortAudio callback thread to the event loop.
+
+    Only wakes the loop when the buffer goes from empty to non-empty. When the
+    WebSocket applies backpressure the sender stops draining and chunks queue
+    up here, to be sent as one larger message once it catches up; the oldest
+    chunk is only dropped past `max_chunks`, and drops are counted so the
+    consumer can report them. Chunk storage comes from a pool of pre-allocated
+    bytearrays that the consumer hands back with `recycle`, so steady-state
+    capture doesn't allocate.
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        chunk_bytes: int,
+        max_chunks: int,
+        pool_size: int = 32,
+    ) -> None:
+        self._loop = loop
+        self._max_chunks = max_chunks
+        self._pool_size = pool_size
+        self._chunks: deque[bytearray] = deque()
+        self._free: deque[bytearray] = deque(
+            bytearray(chunk_bytes) for _ in range(pool_size)
+        )
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._ready = asyncio.Event()
+
+    def put(self, samples: Any) -> None:
+        data = memoryview(samples).cast("B")
+        try:
+            chunk = self._free.pop()
+        except IndexError:
+            chunk = bytearray(len(data))
+        if len(chunk) != len(data):
+            chunk = bytearray(len(data))
+        memoryview(chunk)[:] = data
+
+        with self._lock:
+            was_empty = not self._chunks
+            if len(self._chunks) >= self._max_chunks:
+                self._chunks.popleft()
+                self._dropped += 1
+            self._chunks.append(chunk)
+        if was_empty:
+            self._loop.call_soon_threadsafe(self._ready.set)
+
+    async def drain(self) -> list[bytearray]:
+        await self._ready.wait()
+        with self._lock:
+            chunks = list(self._chunks)
+            self._chunks.clear()
+            self._ready.clear()
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            print(
+                f"\n[audio-backlog] dropped {dropped} chunk(s) while the "
+                "connection was stalled",
+                file=sys.stderr,
+            )
+        return chunks
+
+    def requeue(self, chunks: list[bytearray]) -> None:
+        """Put unsent chunks back in front, e.g. when a session is torn down."""
+        if not chunks:
+            return
+        with self._lock:
+            self._chunks.extendleft(reversed(chunks))
+            while len(self._chunks) > self._max_chunks:
+                self._chunks.popleft()
+                self._dropped += 1
+            self._ready.set()
+
+    def recycle(self, chunks: list[bytearray]) -> None:
+        # Backlog chunks beyond the pool size are left to the GC.
+        room = self._pool_size - len(self._free)
+        if room > 0:
+            self._free.extend(chunks[:room])
+
+
 async def send_audio(
     websocket: Any,
-    audio_queue: asyncio.Queue[bytes],
+    audio_buffer: AudioChunkBuffer,
     sample_rate: int,
+    min_batch_bytes: int,
     commit_strategy: str,
     manual_commit_secs: float,
     previous_text: str | None,
 ) -> None:
-    first_chunk = True
+    # The realtime STT endpoint only accepts audio as base64 inside JSON
+    # `input_audio_chunk` text frames; it has no raw binary PCM mode, so the
+    # encode can't be skipped. The static fields are identical for every
+    # chunk, so render them once and splice the per-chunk audio in as a string
+    # instead of re-serializing a dict.
+    frame_head = (
+        orjson.dumps(
+            {"message_type": "input_audio_chunk", "sample_rate": sample_rate}
+        )[:-1].decode("ascii")
+        + ',"audio_base_64":"'
+    )
     last_commit_at = asyncio.get_running_loop().time()
-    while True:
-        chunk = await audio_queue.get()
-        payload: dict[str, object] = {
-            "message_type": "input_audio_chunk",
-            "audio_base_64": base64.b64encode(chunk).decode("ascii"),
-            "sample_rate": sample_rate,
-        }
+    pending: list[bytearray] = []
+    pending_bytes = 0
+
+    async def next_audio() -> bytes:
+        nonlocal pending_bytes
+        # Several capture chunks go out in one message to cut per-frame
+        # overhead. A backlog left by a stalled send is split into messages
+        # of about the same size rather than sent as one huge frame.
+        while not pending or pending_bytes < min_batch_bytes:
+            for chunk in await audio_buffer.drain():
+                pending.append(chunk)
+                pending_bytes += len(chunk)
+        count = 0
+        batch_bytes = 0
+        while count < len(pending) and batch_bytes < min_batch_bytes:
+            batch_bytes += len(pending[count])
+            count += 1
+        batch = pending[:count]
+        del pending[:count]
+        pending_bytes -= batch_bytes
+        audio = b"".join(batch)
+        audio_buffer.recycle(batch)
+        return audio
+
+    def audio_frame(audio: bytes) -> str:
+        """Everything but the closing brace, so callers can append fields."""
+        nonlocal last_commit_at
+        frame = frame_head + pybase64.b64encode_as_string(audio) + '"'
         if commit_strategy == "manual":
             now = asyncio.get_running_loop().time()
             should_commit = (now - last_commit_at) >= manual_commit_secs
-            payload["commit"] = should_commit
+            frame += ',"commit":true' if should_commit else ',"commit":false'
             if should_commit:
                 last_commit_at = now
-        if first_chunk and previous_text:
-            payload["previous_text"] = previous_text
-        await websocket.send(json.dumps(payload))
-        first_chunk = False
+        return frame
+
+    try:
+        # The protocol has no metadata-only message, so previous_text rides on
+        # the first audio message, sent before the steady-state loop.
+        if previous_text:
+            await websocket.send(
+                audio_frame(await next_audio())
+                + ',"previous_text":'
+                + orjson.dumps(previous_text).decode()
+                + "}"
+            )
+        while True:
+            await websocket.send(audio_frame(await next_audio()) + "}")
+    except asyncio.CancelledError:
+        # Keep audio that was drained but not yet sent for the next session.
+        audio_buffer.requeue(pending)
+        raise
+
+
+# Server events that no reconnect can fix; they end the run.
+FATAL_EVENT_TYPES = frozenset({"auth_error", "quota_exceeded", "unaccepted_terms"})
+# Server-side failures that a fresh session usually clears; they reconnect.
+RESET_EVENT_TYPES = frozenset(
+    {
+        "transcriber_error",
+        "input_error",
+        "resource_exhausted",
+        "queue_overflow",
+        "session_time_limit_exceeded",
+    }
+)
+
+
+class SessionReset(Exception):
+    """The server reported a transient error; start a new session."""
 
 
 async def receive_events(
     websocket: Any,
+    on_committed: Callable[[str], None],
 ) -> None:
     partial_line_active = False
     async for message in websocket:
-        event = json.loads(message)
+        event = orjson.loads(message)
         msg_type = event.get("message_type", "")
 
         if msg_type == "session_started":
@@ -201,8 +378,16 @@ async def receive_events(
                     sys.stdout.write("\n")
                     partial_line_active = False
                 print(f"[final]   {text}")
+                on_committed(text)
             continue
 
+        if msg_type in FATAL_EVENT_TYPES or msg_type in RESET_EVENT_TYPES:
+            if partial_line_active:
+                sys.stdout.write("\n")
+            if msg_type in FATAL_EVENT_TYPES:
+                raise RuntimeError(f"[{msg_type}] {event}")
+            raise SessionReset(f"[{msg_type}] {event}")
+
         if "error" in msg_type:
             if partial_line_active:
                 sys.stdout.write("\n")
@@ -214,73 +399,125 @@ async def receive_events(
         print(f"[{msg_type}] {event}")
 
 
+# Sessions that end sooner than this after connecting count as failures and
+# back off exponentially before the next reconnect.
+RECONNECT_STABLE_SECS = 10.0
+RECONNECT_MIN_DELAY = 1.0
+RECONNECT_MAX_DELAY = 30.0
+
+
+def is_fatal_close(exc: Exception) -> bool:
+    """Policy (1008) and application (4xxx) close codes won't succeed on retry."""
+    rcvd = getattr(exc, "rcvd", None)
+    code = rcvd.code if rcvd is not None else None
+    return code == 1008 or (code is not None and 4000 <= code < 5000)
+
+
 async def run(args: argparse.Namespace) -> None:
     api_key = load_api_key()
     ws_url = make_ws_url(args)
     chunk_frames = int(args.sample_rate * args.chunk_ms / 1000)
+    # 16-bit mono PCM: two bytes per frame.
+    min_batch_bytes = int(args.sample_rate * args.batch_ms / 1000) * 2
     loop = asyncio.get_running_loop()
-    audio_queue: asyncio.Queue[bytes] = asyncio.Queue(maxsize=32)
+    audio_buffer = AudioChunkBuffer(
+        loop,
+        chunk_bytes=chunk_frames * 2,
+        max_chunks=max(1, int(args.max_backlog_secs * 1000 / args.chunk_ms)),
+    )
 
     def on_audio(indata, frames, time_info, status) -> None:
         del frames, time_info
         if status:
             print(f"\n[audio-status] {status}", file=sys.stderr)
-        chunk = indata.tobytes()
+        audio_buffer.put(indata)
 
-        def enqueue() -> None:
-            if audio_queue.full():
-                try:
-                    audio_queue.get_nowait()
-                except asyncio.QueueEmpty:
-                    pass
-            audio_queue.put_nowait(chunk)
+    # The last committed transcript is replayed as previous_text after a
+    # reconnect so the new session keeps some context.
+    previous_text = args.previous_text
 
-        loop.call_soon_threadsafe(enqueue)
+    def on_committed(text: str) -> None:
+        nonlocal previous_text
+        previous_text = text
 
-    headers = {"xi-api-key": api_key}
-    connect_kwargs = {
+    connect_kwargs: dict[str, Any] = {
         "max_size": None,
         "ping_interval": 20,
         "ping_timeout": 20,
     }
-
     # websockets versions differ between `additional_headers` and `extra_headers`.
-    try:
-        websocket = await websockets.connect(
-            ws_url, additional_headers=headers, **connect_kwargs
-        )
-    except TypeError:
-        websocket = await websockets.connect(
-            ws_url, extra_headers=headers, **connect_kwargs
-        )
-
-    try:
-        print("Connected. Speak into your mic. Press Ctrl+C to stop.")
-        print(f"URL: {ws_url}")
-
-        stream = sd.InputStream(
-            samplerate=args.sample_rate,
-            channels=1,
-            dtype="int16",
-            blocksize=chunk_frames,
-            device=args.device,
-            callback=on_audio,
-        )
+    if "additional_headers" in inspect.signature(websockets.connect).parameters:
+        connect_kwargs["additional_headers"] = {"xi-api-key": api_key}
+    else:
+        connect_kwargs["extra_headers"] = {"xi-api-key": api_key}
+
+    stream = sd.InputStream(
+        samplerate=args.sample_rate,
+        channels=1,
+        dtype="int16",
+        blocksize=chunk_frames,
+        device=args.device,
+        callback=on_audio,
+    )
 
-        with stream:
-            await asyncio.gather(
-                send_audio(
-                    websocket,
-                    audio_queue,
-                    args.sample_rate,
-                    args.commit_strategy,
-                    args.manual_commit_secs,
-                    args.previous_text,
+    # Capture keeps running across reconnects; audio recorded while
+    # reconnecting, or drained but not yet sent, waits in the buffer.
+    reconnect_delay = 0.0
+    with stream:
+        async for websocket in websockets.connect(ws_url, **connect_kwargs):
+            print("Connected. Speak into your mic. Press Ctrl+C to stop.")
+            print(f"URL: {ws_url}")
+            connected_at = loop.time()
+
+            tasks = [
+                asyncio.create_task(
+                    send_audio(
+                        websocket,
+                        audio_buffer,
+                        args.sample_rate,
+                        min_batch_bytes,
+                        args.commit_strategy,
+                        args.manual_commit_secs,
+                        previous_text,
+                    )
                 ),
-                receive_events(websocket),
-            )
-    finally:
-        await websocket.close()
+                asyncio.create_task(receive_events(websocket, on_committed)),
+            ]
+            try:
+                done, _ = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    task.result()
+            except (websockets.ConnectionClosedError, SessionReset) as exc:
+                if is_fatal_close(exc):
+                    raise RuntimeError(f"Session closed by server: {exc}") from exc
+                print(f"\n[reconnecting] {exc}", file=sys.stderr)
+            except websockets.ConnectionClosedOK:
+                break
+            else:
+                # receive_events only returns when the server closed cleanly.
+                break
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await websocket.close()
+
+            if loop.time() - connected_at < RECONNECT_STABLE_SECS:
+                reconnect_delay = min(
+                    max(reconnect_delay * 2, RECONNECT_MIN_DELAY),
+                    RECONNECT_MAX_DELAY,
+                )
+                print(
+                    f"[reconnecting] waiting {reconnect_delay:.0f}s",
+                    file=sys.stderr,
+                )
+                await asyncio.sleep(reconnect_delay)
+            else:
+                reconnect_delay = 0.0
+
+    print("\nSession closed by server.")
 
 
 def main() -> int:
@@ -293,7 +530,7 @@ def main() -> int:
             file=sys.stderr,
         )
         print(
-            "Install with: pip install websockets sounddevice",
+            "Install with: pip install websockets sounddevice pybase64 orjson",
             file=sys.stderr,
         )
         return 1
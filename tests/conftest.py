@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# stt.py is a standalone script at the repo root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
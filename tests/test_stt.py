@@ -0,0 +1,235 @@
+import asyncio
+import base64
+import json
+import threading
+from array import array
+
+import pytest
+
+pytest.importorskip("orjson")
+pytest.importorskip("pybase64")
+
+import stt
+
+
+def samples(value: int, frames: int = 2) -> array:
+    return array("h", [value] * frames)
+
+
+def values(chunks) -> list[int]:
+    """First sample of each chunk, to identify it"""
+    return [array("h", bytes(chunk))[0] for chunk in chunks]
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.frames: list[dict] = []
+        # Cleared to simulate a send blocked by backpressure
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    async def send(self, message: str):
+        await self.writable.wait()
+        self.frames.append(json.loads(message))
+
+    def audio(self) -> list[list[int]]:
+        return [
+            list(array("h", base64.b64decode(frame["audio_base_64"])))[::2]
+            for frame in self.frames
+        ]
+
+
+def make_buffer(**kwargs) -> stt.AudioChunkBuffer:
+    kwargs.setdefault("chunk_bytes", 4)
+    kwargs.setdefault("max_chunks", 32)
+    return stt.AudioChunkBuffer(asyncio.get_running_loop(), **kwargs)
+
+
+async def wait_for_frames(websocket: FakeWebSocket, count: int):
+    while len(websocket.frames) < count:
+        await asyncio.sleep(0.005)
+
+
+def test_chunks_from_another_thread_arrive_in_order():
+    async def scenario():
+        buffer = make_buffer(max_chunks=1000)
+
+        def produce():
+            for i in range(200):
+                buffer.put(samples(i))
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        received: list[int] = []
+        while len(received) < 200:
+            received += values(await buffer.drain())
+        producer.join()
+        return received
+
+    assert asyncio.run(scenario()) == list(range(200))
+
+
+def test_oldest_chunks_are_dropped_past_max_and_reported(capsys):
+    async def scenario():
+        buffer = make_buffer(max_chunks=3)
+        for i in range(5):
+            buffer.put(samples(i))
+        return values(await buffer.drain())
+
+    assert asyncio.run(scenario()) == [2, 3, 4]
+    assert "dropped 2 chunk(s)" in capsys.readouterr().err
+
+
+def test_requeue_puts_chunks_back_in_front():
+    async def scenario():
+        buffer = make_buffer(max_chunks=3)
+        buffer.put(samples(1))
+        buffer.put(samples(2))
+        unsent = await buffer.drain()
+        buffer.put(samples(3))
+        buffer.put(samples(4))
+        # One over max_chunks: the oldest requeued chunk goes
+        buffer.requeue(unsent)
+        return values(await buffer.drain())
+
+    assert asyncio.run(scenario()) == [2, 3, 4]
+
+
+def test_recycled_chunks_are_reused_up_to_pool_size():
+    async def scenario():
+        buffer = make_buffer(pool_size=2)
+        for i in range(5):
+            buffer.put(samples(i))
+        chunks = await buffer.drain()
+        buffer.recycle(chunks)
+        pooled = list(buffer._free)
+        buffer.put(samples(9))
+        (reused,) = await buffer.drain()
+        return pooled, reused
+
+    pooled, reused = asyncio.run(scenario())
+    assert len(pooled) == 2
+    assert any(reused is chunk for chunk in pooled)
+    assert values([reused]) == [9]
+
+
+def run_send_audio(scenario, previous_text=None, min_batch_bytes=8):
+    """Runs send_audio against a fake websocket while `scenario` feeds it.
+
+    Returns the websocket and whatever was left in the buffer afterwards.
+    """
+
+    async def runner():
+        buffer = make_buffer(max_chunks=1000)
+        websocket = FakeWebSocket()
+        sender = asyncio.create_task(
+            stt.send_audio(websocket, buffer, 16000, min_batch_bytes, "vad", 0.0, previous_text)
+        )
+        try:
+            await scenario(buffer, websocket)
+        finally:
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+        buffer.put(samples(-1))  # end marker, so drain never blocks
+        return websocket, values(await buffer.drain())[:-1]
+
+    return asyncio.run(runner())
+
+
+def test_chunks_are_batched_and_previous_text_sent_once():
+    async def scenario(buffer, websocket):
+        for i in range(4):
+            buffer.put(samples(i))
+            await asyncio.sleep(0.005)
+        await wait_for_frames(websocket, 2)
+
+    websocket, _ = run_send_audio(scenario, previous_text="earlier context")
+
+    assert websocket.audio() == [[0, 1], [2, 3]]
+    assert websocket.frames[0]["previous_text"] == "earlier context"
+    assert "previous_text" not in websocket.frames[1]
+    assert all(frame["message_type"] == "input_audio_chunk" for frame in websocket.frames)
+
+
+def test_backlog_after_a_stall_is_split_into_batch_sized_messages():
+    async def scenario(buffer, websocket):
+        buffer.put(samples(0))
+        buffer.put(samples(1))
+        await wait_for_frames(websocket, 1)
+        websocket.writable.clear()
+        for i in range(2, 9):
+            buffer.put(samples(i))
+            await asyncio.sleep(0.005)
+        websocket.writable.set()
+        await wait_for_frames(websocket, 4)
+
+    websocket, leftover = run_send_audio(scenario)
+
+    assert websocket.audio() == [[0, 1], [2, 3], [4, 5], [6, 7]]
+    assert leftover == [8]
+
+
+def test_unsent_audio_is_requeued_when_cancelled():
+    async def scenario(buffer, websocket):
+        buffer.put(samples(0))
+        await asyncio.sleep(0.02)
+
+    websocket, leftover = run_send_audio(scenario)
+
+    assert websocket.frames == []
+    assert leftover == [0]
+
+
+def closed_with(code):
+    error = Exception("closed")
+    error.rcvd = None if code is None else type("Close", (), {"code": code})()
+    return error
+
+
+@pytest.mark.parametrize(
+    ("code", "fatal"),
+    [(1008, True), (4000, True), (4999, True), (1006, False), (1011, False), (5000, False), (None, False)],
+)
+def test_is_fatal_close(code, fatal):
+    assert stt.is_fatal_close(closed_with(code)) is fatal
+
+
+class FakeEvents:
+    def __init__(self, *events):
+        self.messages = [json.dumps(event) for event in events]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.messages:
+            raise StopAsyncIteration
+        return self.messages.pop(0)
+
+
+def receive(*events) -> list[str]:
+    committed: list[str] = []
+    asyncio.run(stt.receive_events(FakeEvents(*events), committed.append))
+    return committed
+
+
+@pytest.mark.parametrize("msg_type", sorted(stt.FATAL_EVENT_TYPES))
+def test_fatal_events_end_the_run(msg_type):
+    with pytest.raises(RuntimeError, match=msg_type):
+        receive({"message_type": msg_type})
+
+
+@pytest.mark.parametrize("msg_type", sorted(stt.RESET_EVENT_TYPES))
+def test_transient_errors_reset_the_session(msg_type):
+    with pytest.raises(stt.SessionReset, match=msg_type):
+        receive({"message_type": msg_type})
+
+
+def test_other_errors_are_printed_and_the_session_continues(capsys):
+    committed = receive(
+        {"message_type": "error"},
+        {"message_type": "committed_transcript", "text": " hello "},
+    )
+
+    assert committed == ["hello"]
+    assert "[error]" in capsys.readouterr().out